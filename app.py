@@ -1,10 +1,28 @@
+import hashlib
 import io
+import os
 from pathlib import Path
+from typing import NamedTuple
 
+import numpy as np
 import pandas as pd
 import plotly.express as px
+import plotly.graph_objects as go
+from plotly.subplots import make_subplots
 import streamlit as st
 
+try:
+    import datashader as ds
+    import datashader.transfer_functions as tf
+except ImportError:
+    ds = None
+
+try:
+    import fastexcel  # noqa: F401
+    import polars as pl
+except ImportError:
+    pl = None
+
 # ---------------------- Page config ----------------------
 st.set_page_config(
     page_title="Economic Dashboard",
@@ -17,31 +35,95 @@ st.caption("Интерактивные диаграммы по данным из
 
 # ---------------------- Helpers ----------------------
 REQUIRED_COLS = ["real_GVA", "real_support", "real_subsidies"]
+INDUSTRY_CANDIDATES = ["industry", "отрасль", "sector"]
+# Колонки, которые читаем из Excel; остальные не материализуем
+EXTRA_COLS = ["date", "region", "регион"] + INDUSTRY_CANDIDATES
+
+# Начиная с этого числа точек SVG заметно тормозит, переключаемся на WebGL
+WEBGL_MIN_POINTS = 1000
+# При таком объёме и WebGL не справляется: рисуем плотность растром (datashader),
+# а поверх — прореженную выборку точек для подсказок
+DATASHADER_MIN_POINTS = 50_000
+HOVER_SAMPLE_POINTS = 5_000
+# Версия формата очищенных данных в parquet-кэше; увеличивать при изменении _clean
+CLEAN_VERSION = 2
+
+def _to_year(values: pd.Series) -> pd.Series:
+    # Колонка года может прийти ячейками-датами (datetime64): берём .dt.year,
+    # иначе to_numeric превратил бы даты в наносекунды
+    if pd.api.types.is_datetime64_any_dtype(values):
+        return values.dt.year
+    return pd.to_numeric(values, errors="coerce")
 
 def _ensure_year_column(df: pd.DataFrame) -> pd.DataFrame:
     cols_lower = {c.lower(): c for c in df.columns}
     if "year" in cols_lower:
-        df["year"] = pd.to_numeric(df[cols_lower["year"]], errors="coerce")
+        df["year"] = _to_year(df[cols_lower["year"]])
         return df
     if "год" in cols_lower:
-        df["year"] = pd.to_numeric(df[cols_lower["год"]], errors="coerce")
+        df["year"] = _to_year(df[cols_lower["год"]])
         return df
     if "date" in cols_lower:
         df["year"] = pd.to_datetime(df[cols_lower["date"]], errors="coerce").dt.year
         return df
     for col in df.columns:
         if "year" in col.lower() or "год" in col.lower():
-            df["year"] = pd.to_numeric(df[col], errors="coerce")
+            df["year"] = _to_year(df[col])
             return df
     raise ValueError("Не найдена колонка с годом")
 
-@st.cache_data(show_spinner=False)
+def _wanted_column(name) -> bool:
+    name = str(name)
+    lower = name.lower()
+    return name in REQUIRED_COLS or lower in EXTRA_COLS or "year" in lower or "год" in lower
+
+def _render_mode(data: pd.DataFrame) -> str:
+    return "webgl" if len(data) >= WEBGL_MIN_POINTS else "svg"
+
+def _sha1_digest(content) -> str:
+    if isinstance(content, io.BytesIO):
+        content = content.getbuffer()
+    return hashlib.sha1(content).hexdigest()
+
+def _upload_digest(content) -> str:
+    # sha1 загруженного файла считается один раз на file_id и хранится
+    # в session_state; на последующих rerun буфер не перечитывается
+    file_id = getattr(content, "file_id", None)
+    if file_id is None:
+        return _sha1_digest(content)
+    cached = st.session_state.get("upload_digest")
+    if cached is None or cached[0] != file_id:
+        cached = (file_id, _sha1_digest(content))
+        st.session_state["upload_digest"] = cached
+    return cached[1]
+
+def _excel_engine() -> str:
+    try:
+        import python_calamine  # noqa: F401
+    except ImportError:
+        return "openpyxl"
+    return "calamine"
+
+def _read_excel(source, sheet_name: str) -> pd.DataFrame:
+    if pl is not None:
+        # polars + calamine читают быстрее pandas. Сначала читаем только
+        # заголовок, затем — лишь нужные колонки, остальные ридер пропускает
+        header = pl.read_excel(source, sheet_name=sheet_name, engine="calamine", read_options={"n_rows": 0})
+        if isinstance(source, io.BytesIO):
+            source.seek(0)
+        return pl.read_excel(
+            source, sheet_name=sheet_name, engine="calamine", infer_schema_length=None,
+            columns=[c for c in header.columns if _wanted_column(c)]
+        ).to_pandas()
+    return pd.read_excel(source, sheet_name=sheet_name, engine=_excel_engine(), usecols=_wanted_column)
+
 def load_excel(content_or_path, sheet_name: str = "Данные") -> pd.DataFrame:
     if isinstance(content_or_path, (bytes, bytearray)):
-        return pd.read_excel(io.BytesIO(content_or_path), sheet_name=sheet_name, engine="openpyxl")
+        return _read_excel(io.BytesIO(content_or_path), sheet_name)
     if isinstance(content_or_path, io.BytesIO):
-        return pd.read_excel(content_or_path, sheet_name=sheet_name, engine="openpyxl")
-    return pd.read_excel(content_or_path, sheet_name=sheet_name, engine="openpyxl")
+        content_or_path.seek(0)
+        return _read_excel(content_or_path, sheet_name)
+    return _read_excel(content_or_path, sheet_name)
 
 def ensure_required_columns(df: pd.DataFrame):
     missing = [c for c in REQUIRED_COLS if c not in df.columns]
@@ -49,54 +131,198 @@ def ensure_required_columns(df: pd.DataFrame):
         st.error(f"В данных отсутствуют обязательные колонки: {', '.join(missing)}")
         st.stop()
 
+def coerce_numeric(df: pd.DataFrame) -> pd.DataFrame:
+    # float32 вдвое уменьшает объём данных, который уходит в Plotly
+    for c in REQUIRED_COLS:
+        df[c] = pd.to_numeric(df[c], errors="coerce").astype("float32")
+    return df
+
+def _clean(df: pd.DataFrame) -> pd.DataFrame:
+    df = _ensure_year_column(df)
+    ensure_required_columns(df)
+    df = coerce_numeric(df)
+    # _ensure_year_column уже вернул числа; значения вне диапазона лет
+    # отбрасываем, чтобы astype("int16") не переполнился
+    df["year"] = df["year"].where(df["year"].between(1, 9999))
+    df = df.dropna(subset=["year"])
+    df["year"] = df["year"].astype("int16")
+    # Отрасль как category: isin и группировка работают по целочисленным кодам
+    for c in INDUSTRY_CANDIDATES:
+        if c in df.columns:
+            df[c] = df[c].astype("category")
+    # Сортировка по году позволяет выбирать диапазоны лет бинарным поиском
+    return df.sort_values("year", kind="stable").reset_index(drop=True)
+
+class LoadedData(NamedTuple):
+    df: pd.DataFrame
+    year_min: int
+    year_max: int
+
+def _with_years(df: pd.DataFrame) -> LoadedData:
+    # Границы лет считаются один раз при загрузке, а не на каждом rerun;
+    # df отсортирован по году, поэтому это первое и последнее значения
+    years = df["year"].to_numpy()
+    return LoadedData(df, int(years[0]), int(years[-1]))
+
+def _year_slice(data: pd.DataFrame, lo: int, hi: int) -> pd.DataFrame:
+    years = data["year"].to_numpy()
+    # Годы целые, поэтому правая граница — первый индекс со значением > hi
+    i0, i1 = np.searchsorted(years, [lo, hi + 1])
+    return data.iloc[i0:i1]
+
+def _finite_range(values):
+    finite = values[np.isfinite(values)]
+    if finite.size == 0 or finite.min() == finite.max():
+        return None
+    return float(finite.min()), float(finite.max())
+
+def _density_image(x, y, x_range: tuple, y_range: tuple):
+    cvs = ds.Canvas(plot_width=800, plot_height=500, x_range=x_range, y_range=y_range)
+    agg = cvs.points(pd.DataFrame({"x": x, "y": y}), "x", "y")
+    return tf.shade(agg, how="eq_hist").to_pil()
+
+def _hovertemplate(hover_cols: list) -> str:
+    # Значения хранятся во float32: формат d3 скрывает шум округления,
+    # год и отрасль выводятся как есть
+    lines = [
+        f"{c}=%{{customdata[{i}]:,.6~g}}" if c in REQUIRED_COLS else f"{c}=%{{customdata[{i}]}}"
+        for i, c in enumerate(hover_cols)
+    ]
+    return "<br>".join(lines) + "<extra></extra>"
+
+def _color_values(data: pd.DataFrame, color_by: str):
+    # Отрасль отдаётся как Categorical (коды по полному списку категорий),
+    # год — обычным массивом
+    values = data[color_by]
+    if isinstance(values.dtype, pd.CategoricalDtype):
+        return values.array
+    return values.to_numpy()
+
+def _marker_traces(x, y, color, customdata, hovertemplate: str,
+                   showlegend: bool = True, size=None) -> list:
+    trace_cls = go.Scattergl if len(x) >= WEBGL_MIN_POINTS else go.Scatter
+    if not isinstance(color, pd.Categorical):
+        return [trace_cls(
+            x=x, y=y, mode="markers", customdata=customdata, hovertemplate=hovertemplate,
+            marker=dict(color=color, coloraxis="coloraxis", size=size, sizemode="diameter"),
+            showlegend=False
+        )]
+    # Для категорий — отдельный трейс на значение; цвет берётся по коду
+    # в полном списке категорий, поэтому отрасль сохраняет цвет при любых
+    # фильтрах и на всех графиках, а легенда идёт в порядке категорий
+    palette = px.colors.qualitative.Plotly
+    codes = color.codes
+    traces = []
+    for k, name in enumerate(color.categories):
+        sel = codes == k
+        if not sel.any():
+            continue
+        traces.append(trace_cls(
+            x=x[sel], y=y[sel], mode="markers", name=str(name), legendgroup=str(name),
+            customdata=customdata[sel], hovertemplate=hovertemplate,
+            marker=dict(
+                color=palette[k % len(palette)],
+                size=None if size is None else size[sel], sizemode="diameter"
+            ),
+            showlegend=showlegend
+        ))
+    return traces
+
+def _bubble_sizes(values, size_max: float = 40.0):
+    # Диаметр пропорционален корню из значения (площадь — значению),
+    # наибольший пузырь — size_max пикселей, как size_max в px.scatter
+    g = np.asarray(values, dtype=np.float32)
+    g = np.where(np.isfinite(g) & (g > 0), g, 0)
+    scale = size_max / np.sqrt(g.max() if g.size and g.max() > 0 else 1.0)
+    return (np.sqrt(g) * scale).astype(np.float32)
+
+# Вся предобработка кэшируется целиком: при движении слайдеров
+# выполняется только фильтрация. Ключ — digest загрузки из _upload_digest,
+# сам файл передаётся параметром _content и Streamlit его не хэширует.
+# cache_resource отдаёт сам объект без копии (cache_data копирует df на каждом
+# rerun); код ниже df и его срезы только читает
+@st.cache_resource(max_entries=4, ttl="1h", show_spinner=False)
+def _load_and_clean_bytes(digest: str, _content, sheet_name: str) -> LoadedData:
+    return _with_years(_clean(load_excel(_content, sheet_name)))
+
+# Локальный файл кэшируется по (путь, mtime, размер)
+@st.cache_resource(max_entries=4, ttl="1h", show_spinner=False)
+def _load_and_clean_file(file_key: tuple, sheet_name: str) -> LoadedData:
+    path = Path(file_key[0])
+    # Очищенные данные сохраняются рядом с Excel-файлом (по файлу на лист и
+    # версию _clean): при следующем запуске читается parquet, если он не старше xlsx
+    parquet_path = path.with_name(f"{path.stem}.{sheet_name}.v{CLEAN_VERSION}.parquet")
+    if parquet_path.exists() and parquet_path.stat().st_mtime_ns >= file_key[1]:
+        try:
+            return _with_years(pd.read_parquet(parquet_path))
+        except (OSError, ValueError):
+            # Повреждённый кэш (ArrowInvalid — подкласс ValueError): читаем xlsx заново
+            pass
+    df = _clean(load_excel(path, sheet_name))
+    # Пишем во временный файл и атомарно подменяем, чтобы оборванная запись
+    # не оставила обрезанный parquet
+    tmp_path = parquet_path.with_name(f"{parquet_path.name}.{os.getpid()}.tmp")
+    try:
+        df.to_parquet(tmp_path, compression="zstd", index=False)
+        os.replace(tmp_path, parquet_path)
+    except (OSError, ValueError, TypeError):
+        # Запись кэша — необязательная: нет прав на запись или pyarrow
+        # не смог сконвертировать колонку со смешанными типами
+        try:
+            tmp_path.unlink(missing_ok=True)
+        except OSError:
+            pass
+    return _with_years(df)
+
+def load_and_clean(content_or_path, sheet_name: str = "Данные") -> LoadedData:
+    if isinstance(content_or_path, (bytes, bytearray, io.BytesIO)):
+        return _load_and_clean_bytes(_upload_digest(content_or_path), content_or_path, sheet_name)
+    path = Path(content_or_path)
+    stat = path.stat()
+    return _load_and_clean_file((str(path), stat.st_mtime_ns, stat.st_size), sheet_name)
+
 # ---------------------- Data input ----------------------
 st.sidebar.header("Данные")
 sheet_name = st.sidebar.text_input("Лист Excel", value="Данные")
 uploaded = st.sidebar.file_uploader("Загрузите Excel-файл (.xlsx)", type=["xlsx"])
 default_path = Path("Data.xlsx")
 
-df = None
+data = None
 if uploaded is not None:
-    df = load_excel(uploaded.getvalue(), sheet_name=sheet_name)
+    # UploadedFile передаётся как есть: getvalue() копировал бы буфер на каждом rerun
+    data = load_and_clean(uploaded, sheet_name=sheet_name)
 elif default_path.exists():
-    df = load_excel(default_path, sheet_name=sheet_name)
+    data = load_and_clean(default_path, sheet_name=sheet_name)
     st.sidebar.info("Используется локальный файл Data.xlsx")
 else:
     st.warning("Загрузите файл Excel или поместите Data.xlsx в корень репозитория")
     st.stop()
 
-df = _ensure_year_column(df)
-ensure_required_columns(df)
-
-# Приводим колонку year к int
-df["year"] = pd.to_datetime(df["year"], errors="coerce").dt.year
-df = df.dropna(subset=["year"])
-df["year"] = df["year"].astype(int)
-
 # ---------------------- Sidebar filters ----------------------
 # Диапазон лет (старый функционал)
-year_min, year_max = int(df["year"].min()), int(df["year"].max())
+df = data.df
 selected_years = st.sidebar.slider(
     "Выберите диапазон лет",
-    min_value=year_min,
-    max_value=year_max,
-    value=(year_min, year_max),
+    min_value=data.year_min,
+    max_value=data.year_max,
+    value=(data.year_min, data.year_max),
     step=1,
     key="year_range_slider"
 )
 
 # Фильтр по отраслям (новый функционал)
 industry_col = None
-for candidate in ["industry", "отрасль", "sector"]:
+for candidate in INDUSTRY_CANDIDATES:
     if candidate in df.columns:
         industry_col = candidate
         break
 
 selected_industries = None
 if industry_col:
-    industries = sorted(df[industry_col].dropna().unique())
+    industries = list(df[industry_col].cat.categories)
     selected_industries = st.sidebar.multiselect(
-        "Выберите отрасли", options=industries, default=industries, key="industry_filter"
+        "Выберите отрасли", options=industries, default=None,
+        placeholder="Все отрасли", key="industry_filter"
     )
 
 # Выбор раскраски (новый функционал)
@@ -108,13 +334,17 @@ color_by = st.sidebar.selectbox("Цвет точек по", options=color_option
 
 # ---------------------- Apply filters ----------------------
 # Базовая фильтрация по диапазону лет
-dff = df[(df["year"] >= selected_years[0]) & (df["year"] <= selected_years[1])].copy()
+# df отсортирован по году, поэтому это срез без маски и копирования
+dff = _year_slice(df, selected_years[0], selected_years[1])
 
-# Фильтрация по отраслям (если выбраны)
-if selected_industries is not None:
+# Фильтрация по отраслям (пустой выбор означает все отрасли)
+if selected_industries:
     dff = dff[dff[industry_col].isin(selected_industries)]
 
 # ---------------------- Charts ----------------------
+# В подсказки идут только ключевые колонки, а не весь датафрейм
+hover_cols = ["year"] + REQUIRED_COLS + ([industry_col] if industry_col else [])
+
 st.markdown("### Фильтры")
 c1, c2, c3 = st.columns(3)
 c1.metric("Мин. год", selected_years[0])
@@ -123,41 +353,108 @@ c3.metric("Число наблюдений", len(dff))
 
 st.divider()
 
-# Chart 1: real_GVA vs real_support
-fig1 = px.scatter(dff, x="real_support", y="real_GVA", color=color_by, hover_data=dff.columns)
-st.plotly_chart(fig1, use_container_width=True)
-
-# Chart 2: real_GVA vs real_subsidies
-fig2 = px.scatter(dff, x="real_subsidies", y="real_GVA", color=color_by, hover_data=dff.columns)
-st.plotly_chart(fig2, use_container_width=True)
+# Charts 1–2: real_GVA vs real_support и real_subsidies в одной фигуре
+# с общей осью Y — один WebGL-контекст и один JSON вместо двух
+fig = make_subplots(rows=1, cols=2, shared_yaxes=True, horizontal_spacing=0.04)
+# Колонки переводятся в непрерывные массивы float32 один раз на dff
+x_sup = dff["real_support"].to_numpy(np.float32)
+x_sub = dff["real_subsidies"].to_numpy(np.float32)
+y_gva = dff["real_GVA"].to_numpy(np.float32)
+panels = [("real_support", x_sup), ("real_subsidies", x_sub)]
+y_range = _finite_range(y_gva)
+x_ranges = [_finite_range(x) for _, x in panels]
+# Растр рисуется, только если у всех осей есть конечный диапазон; прореживаем
+# точки лишь тогда, иначе они пропали бы без замены картинкой
+rasterize = (
+    ds is not None and len(dff) > DATASHADER_MIN_POINTS
+    and y_range is not None and all(x_ranges)
+)
+sample = slice(None, None, len(dff) // HOVER_SAMPLE_POINTS + 1) if rasterize else slice(None)
+# Цвет и подсказки нужны только точкам, которые реально уходят в браузер
+dff_points = dff.iloc[sample]
+color = _color_values(dff_points, color_by)
+customdata = dff_points[hover_cols].to_numpy()
+hovertemplate = _hovertemplate(hover_cols)
+for col, ((x_name, x), x_range) in enumerate(zip(panels, x_ranges), start=1):
+    if rasterize:
+        fig.add_layout_image(
+            dict(
+                source=_density_image(x, y_gva, x_range, y_range),
+                x=x_range[0], y=y_range[1],
+                sizex=x_range[1] - x_range[0], sizey=y_range[1] - y_range[0],
+                xanchor="left", yanchor="top", sizing="stretch", layer="below"
+            ),
+            row=1, col=col
+        )
+        # Автомасштаб видит только выборку и обрезал бы выбросы с картинки
+        fig.update_xaxes(range=x_range, row=1, col=col)
+    for trace in _marker_traces(
+        x[sample], y_gva[sample], color,
+        customdata, hovertemplate, showlegend=col == 1
+    ):
+        fig.add_trace(trace, row=1, col=col)
+    fig.update_xaxes(title_text=x_name, row=1, col=col)
+if rasterize:
+    fig.update_yaxes(range=y_range)
+    # Выборка поверх растра нужна для подсказок и не должна его закрывать
+    fig.update_traces(marker=dict(size=3, opacity=0.15))
+fig.update_yaxes(title_text="real_GVA", row=1, col=1)
+fig.update_layout(coloraxis=dict(colorbar=dict(title=color_by)), uirevision="dashboard")
+st.plotly_chart(fig, use_container_width=True)
 
 # Chart 3: Bubble
-st.subheader("Пузырьковая диаграмма")
-autoplay = st.sidebar.checkbox("Автоплей по годам", value=False, key="autoplay_checkbox")
-
-if autoplay:
-    # Автоматическая анимация
-    fig3 = px.scatter(
-        dff,
-        x="real_support", y="real_subsidies",
-        size="real_GVA", color=color_by,
-        size_max=40, hover_data=dff.columns,
-        animation_frame="year",
-        animation_group=industry_col if industry_col else None
-    )
-    st.plotly_chart(fig3, use_container_width=True)
-else:
-    # Ручной выбор года
-    year_player = st.sidebar.select_slider(
-        "Год (проигрыватель)",
-        options=sorted(dff["year"].unique()),
-        key="year_player_slider"
-    )
-    df_year = dff[dff["year"] == year_player]
-    fig3 = px.scatter(
-        df_year,
-        x="real_support", y="real_subsidies",
-        size="real_GVA", color=color_by,
-        size_max=40, hover_data=df_year.columns
-    )
-    st.plotly_chart(fig3, use_container_width=True)
+# Фрагмент перезапускается отдельно: переключение года в проигрывателе
+# перестраивает только пузырьковую диаграмму, без загрузки и фильтрации данных
+@st.fragment
+def render_bubble(dff: pd.DataFrame, years: list, color_by: str, hover_cols: list, industry_col):
+    st.subheader("Пузырьковая диаграмма")
+    c_play, c_year = st.columns([1, 3])
+    autoplay = c_play.checkbox("Автоплей по годам", value=False, key="autoplay_checkbox")
+
+    if autoplay:
+        # Автоматическая анимация; цвета отраслей — те же, что в _marker_traces
+        color_kwargs = {}
+        if isinstance(dff[color_by].dtype, pd.CategoricalDtype):
+            categories = list(dff[color_by].cat.categories)
+            palette = px.colors.qualitative.Plotly
+            color_kwargs = dict(
+                category_orders={color_by: categories},
+                color_discrete_map={c: palette[k % len(palette)] for k, c in enumerate(categories)},
+            )
+        fig3 = px.scatter(
+            dff,
+            x="real_support", y="real_subsidies",
+            size="real_GVA", color=color_by,
+            size_max=40, hover_data=hover_cols,
+            **color_kwargs,
+            animation_frame="year",
+            animation_group=industry_col if industry_col else None,
+            render_mode=_render_mode(dff)
+        )
+        st.plotly_chart(fig3, use_container_width=True)
+    else:
+        # Ручной выбор года
+        year_player = c_year.select_slider(
+            "Год (проигрыватель)",
+            options=years,
+            key="year_player_slider"
+        )
+        df_year = _year_slice(dff, year_player, year_player)
+        # Размеры пузырей считаются в NumPy, а не в браузере
+        fig3 = go.Figure(_marker_traces(
+            df_year["real_support"].to_numpy(np.float32),
+            df_year["real_subsidies"].to_numpy(np.float32),
+            _color_values(df_year, color_by),
+            df_year[hover_cols].to_numpy(), _hovertemplate(hover_cols),
+            size=_bubble_sizes(df_year["real_GVA"].to_numpy(np.float32))
+        ))
+        fig3.update_layout(
+            xaxis_title="real_support", yaxis_title="real_subsidies",
+            coloraxis=dict(colorbar=dict(title=color_by))
+        )
+        st.plotly_chart(fig3, use_container_width=True)
+
+# Годы проигрывателя берутся из уже отфильтрованного dff, чтобы учитывать
+# выбор отраслей; dff отсортирован по году, поэтому это дёшево
+player_years = [int(y) for y in np.unique(dff["year"].to_numpy())]
+render_bubble(dff, player_years, color_by, hover_cols, industry_col)